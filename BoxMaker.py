@@ -1,5 +1,6 @@
 import FreeCAD, FreeCADGui
-from PySide import QtGui, QtCore
+if FreeCAD.GuiUp:
+    from PySide import QtGui, QtCore
 import Part
 import math
 import common
@@ -243,4 +244,5 @@ class BoxMaker:
     def IsActive(self):
         return True
 
-FreeCADGui.addCommand("Make_Box_Command", BoxMaker())
+if FreeCAD.GuiUp:
+    FreeCADGui.addCommand("Make_Box_Command", BoxMaker())
@@ -1,5 +1,6 @@
 import FreeCAD, FreeCADGui
-from PySide import QtGui
+if FreeCAD.GuiUp:
+    from PySide import QtGui
 import Draft, Part, math, common
 
 class CompartmentFeature:
@@ -326,5 +327,6 @@ class AddCompartment:
     def IsActive(self):
         return True
 
-FreeCADGui.addCommand("Add_Compartment_Command", AddCompartment())
+if FreeCAD.GuiUp:
+    FreeCADGui.addCommand("Add_Compartment_Command", AddCompartment())
 
@@ -0,0 +1,389 @@
+"""
+Local generation service for board game inserts.
+
+Keeps a pool of warm FreeCADCmd processes running InsertWorker.py so a
+request only pays for the build itself, not for FreeCAD startup. Runs with
+a plain Python 3 interpreter; only the workers need FreeCAD.
+
+    python InsertServer.py --workers 4 --socket /tmp/insert.sock
+    python InsertServer.py --workers 4 --port 8765
+
+Clients send one JSON object per line and get one JSON object per line back:
+
+    {"id": 1, "spec": {"box": {"Length": 120}, "compartments": [...],
+                       "format": "step"}, "timeout": 30}
+    {"id": 1, "ok": true, "data": "<base64>", "build_time": 0.4,
+     "latency": 0.5}
+
+    {"cmd": "metrics"}
+
+See InsertWorker.build for the spec layout. "output" in a spec is only
+accepted when the server runs with --output-dir: true picks a generated
+file name, a string names a plain file inside that directory, and the reply
+carries the written "path" instead of "data". Requests on one connection are
+answered in order; open several connections to build in parallel.
+"""
+import os, sys, json, time, uuid, asyncio, argparse, statistics
+from collections import deque
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+# replies carry whole STL/STEP files base64 encoded on a single line
+LINE_LIMIT = 256 * 1024 * 1024
+# requests are only specs
+REQUEST_LIMIT = 1024 * 1024
+
+def worker_command(freecad):
+    """
+    Builds the argv that starts one worker.
+
+    FreeCADCmd imports a .py argument as a module rather than running it as
+    __main__, so the worker is started through -c instead.
+    """
+    code = f"import sys; sys.path.insert(0, {MODULE_DIR!r}); import InsertWorker; InsertWorker.main()"
+    return [freecad, "-c", code]
+
+def resolve_output(output_dir, output, fmt):
+    """
+    Turns the "output" of a spec into a file path inside output_dir.
+
+    Args:
+        output_dir (str): Directory the server may write to, or None.
+        output (bool or str): True for a generated name, otherwise a plain
+            file name without any directory part.
+        fmt (str): Export format, used as the suffix of generated names.
+
+    Returns:
+        str: The absolute path the worker should write.
+    """
+    if not output_dir:
+        raise ValueError("File output is disabled, start the server with --output-dir")
+    if output is True:
+        output = f"{uuid.uuid4().hex}.{fmt}"
+    if not isinstance(output, str) or not output or output.startswith(".") \
+            or os.path.basename(output) != output or os.sep in output or "/" in output:
+        raise ValueError("output must be true or a plain file name")
+    path = os.path.join(os.path.realpath(output_dir), output)
+    if os.path.islink(path):
+        raise ValueError("output must not be a symbolic link")
+    return path
+
+class Worker:
+    def __init__(self, proc):
+        self.proc = proc
+
+    @classmethod
+    async def start(cls, command, startup_timeout, env=None):
+        proc = await asyncio.create_subprocess_exec(
+            *command, env=env, limit=LINE_LIMIT,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        worker = cls(proc)
+        try:
+            await asyncio.wait_for(worker._wait_ready(), startup_timeout)
+        except BaseException:
+            await worker.stop()
+            raise
+        return worker
+
+    async def _wait_ready(self):
+        # skip anything FreeCAD prints before the worker takes over stdout
+        while True:
+            line = await self.proc.stdout.readline()
+            if not line:
+                raise RuntimeError("Worker exited during startup")
+            try:
+                if json.loads(line).get("ready"):
+                    return
+            except ValueError:
+                pass
+
+    @property
+    def alive(self):
+        return self.proc.returncode is None
+
+    async def build(self, spec):
+        try:
+            self.proc.stdin.write(json.dumps(spec).encode() + b"\n")
+            await self.proc.stdin.drain()
+            line = await self.proc.stdout.readline()
+        except OSError:
+            # ConnectionError included, the pipes break when the worker dies
+            raise RuntimeError("Worker exited during build")
+        if not line:
+            raise RuntimeError("Worker exited during build")
+        return json.loads(line)
+
+    def kill(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+
+    async def stop(self):
+        self.kill()
+        await self.proc.wait()
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.started = time.monotonic()
+        self.counts = dict.fromkeys(["requests", "completed", "failed", "timeouts", "rejected"], 0)
+        # (finish time, total latency, queue wait, build time) of recent requests
+        self.recent = deque(maxlen=window)
+
+    def record(self, latency, wait, build_time):
+        self.recent.append((time.monotonic(), latency, wait, build_time))
+
+    def snapshot(self):
+        now = time.monotonic()
+        uptime = now - self.started
+        latencies = sorted(r[1] for r in self.recent)
+        snap = dict(self.counts, uptime=uptime,
+                    throughput=self.counts["completed"] / uptime if uptime else 0.0,
+                    throughput_60s=sum(1 for r in self.recent if now - r[0] <= 60) / min(uptime, 60) if uptime else 0.0)
+        if latencies:
+            snap["latency"] = {
+                "mean": statistics.mean(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+                "max": latencies[-1],
+            }
+            snap["queue_wait_mean"] = statistics.mean(r[2] for r in self.recent)
+            snap["build_time_mean"] = statistics.mean(r[3] for r in self.recent)
+        return snap
+
+class WorkerPool:
+    def __init__(self, command, size=2, max_queue=64, timeout=60.0, startup_timeout=120.0, env=None):
+        self.command = command
+        self.env = env
+        self.size = size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.metrics = Metrics()
+        self._idle = asyncio.Queue()
+        self._workers = set()
+        self._respawns = set()
+        self._waiting = 0
+        self._closed = False
+
+    async def start(self):
+        results = await asyncio.gather(*[self._spawn() for _ in range(self.size)], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await self.close()
+            raise errors[0]
+        for worker in results:
+            self._idle.put_nowait(worker)
+
+    async def _spawn(self):
+        worker = await Worker.start(self.command, self.startup_timeout, self.env)
+        self._workers.add(worker)
+        return worker
+
+    def _replace(self, worker):
+        """Kills a worker whose state is unknown and starts a fresh one in the background."""
+        worker.kill()
+        self._workers.discard(worker)
+        task = asyncio.ensure_future(self._respawn(worker))
+        self._respawns.add(task)
+        task.add_done_callback(self._respawns.discard)
+
+    async def _respawn(self, old):
+        await old.stop()
+        delay = 1.0
+        while not self._closed:
+            try:
+                worker = await self._spawn()
+            except Exception as e:
+                print(f"Failed to start worker: {e}", file=sys.stderr)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+                continue
+            # once closed, close() stops everything left in _workers
+            if not self._closed:
+                self._idle.put_nowait(worker)
+            return
+
+    async def generate(self, spec, timeout=None):
+        """
+        Builds one spec on the next free worker.
+
+        Args:
+            spec (dict): The build spec, see InsertWorker.build.
+            timeout (float): Seconds allowed for queuing and building together.
+
+        Returns:
+            dict: The worker reply with "latency" and "queue_wait" added.
+        """
+        counts = self.metrics.counts
+        counts["requests"] += 1
+        # only requests left without an idle worker count against the limit
+        if self._waiting - self._idle.qsize() >= self.max_queue:
+            counts["rejected"] += 1
+            raise RuntimeError("Request queue is full")
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self._waiting += 1
+        try:
+            while True:
+                worker = await asyncio.wait_for(self._idle.get(), start + timeout - loop.time())
+                if worker.alive:
+                    break
+                # died while idle, e.g. a FreeCAD crash between requests
+                self._replace(worker)
+        except asyncio.TimeoutError:
+            counts["timeouts"] += 1
+            raise
+        finally:
+            self._waiting -= 1
+        wait = loop.time() - start
+        if wait >= timeout:
+            # the budget went on queuing, the worker itself is still healthy
+            self._idle.put_nowait(worker)
+            counts["timeouts"] += 1
+            raise asyncio.TimeoutError()
+        try:
+            reply = await asyncio.wait_for(worker.build(spec), timeout - wait)
+        except asyncio.TimeoutError:
+            counts["timeouts"] += 1
+            self._replace(worker)
+            raise
+        except BaseException:
+            counts["failed"] += 1
+            self._replace(worker)
+            raise
+        self._idle.put_nowait(worker)
+        latency = loop.time() - start
+        if reply.get("ok"):
+            counts["completed"] += 1
+            self.metrics.record(latency, wait, reply.get("build_time", 0.0))
+        else:
+            counts["failed"] += 1
+        reply.update(latency=latency, queue_wait=wait)
+        return reply
+
+    def status(self):
+        return dict(self.metrics.snapshot(), workers=len(self._workers),
+                    idle=self._idle.qsize(), queued=self._waiting)
+
+    async def close(self):
+        self._closed = True
+        respawns = list(self._respawns)
+        for task in respawns:
+            task.cancel()
+        await asyncio.gather(*respawns, return_exceptions=True)
+        await asyncio.gather(*[w.stop() for w in self._workers])
+        self._workers.clear()
+
+class InsertServer:
+    def __init__(self, pool, output_dir=None):
+        self.pool = pool
+        self.output_dir = output_dir
+
+    async def dispatch(self, request):
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "Request must be a JSON object"}
+        cmd = request.get("cmd", "build")
+        if cmd == "metrics":
+            return {"ok": True, "metrics": self.pool.status()}
+        if cmd != "build":
+            return {"ok": False, "error": f"Unknown command '{cmd}'"}
+        spec = request.get("spec", {})
+        if not isinstance(spec, dict):
+            return {"ok": False, "error": "spec must be a JSON object"}
+        if spec.get("output") not in (None, False):
+            fmt = spec.get("format", "stl")
+            if not isinstance(fmt, str):
+                return {"ok": False, "error": "format must be a string"}
+            try:
+                output = resolve_output(self.output_dir, spec["output"], fmt.lower())
+            except ValueError as e:
+                return {"ok": False, "error": str(e)}
+            spec = dict(spec, output=output)
+        timeout = request.get("timeout")
+        if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))
+                                    or not 0 < timeout < float("inf")):
+            return {"ok": False, "error": "timeout must be a positive number of seconds"}
+        if timeout is None:
+            timeout = self.pool.timeout
+        try:
+            return await self.pool.generate(spec, timeout)
+        except asyncio.TimeoutError:
+            return {"ok": False, "error": f"Timed out after {timeout}s"}
+        except (RuntimeError, ValueError) as e:
+            return {"ok": False, "error": str(e)}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # longer than REQUEST_LIMIT, the stream can't be resynced
+                    writer.write(json.dumps({"ok": False, "error": "Request too large"}).encode() + b"\n")
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    reply = {"ok": False, "error": "Request is not valid JSON"}
+                else:
+                    try:
+                        reply = await self.dispatch(request)
+                    except Exception as e:
+                        reply = {"ok": False, "error": f"Internal error: {e!r}"}
+                    if isinstance(request, dict) and "id" in request:
+                        reply["id"] = request["id"]
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def serve(args):
+    env = dict(os.environ)
+    if args.output_dir:
+        args.output_dir = os.path.realpath(args.output_dir)
+        os.makedirs(args.output_dir, exist_ok=True)
+        env["BIW_OUTPUT_DIR"] = args.output_dir
+    pool = WorkerPool(worker_command(args.freecad), args.workers, args.max_queue, args.timeout, env=env)
+    await pool.start()
+    server = InsertServer(pool, args.output_dir)
+    if args.socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.socket, limit=REQUEST_LIMIT)
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port, limit=REQUEST_LIMIT)
+    print(f"Serving with {args.workers} workers on {args.socket or f'{args.host}:{args.port}'}", file=sys.stderr)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm FreeCAD insert generation service")
+    parser.add_argument("--freecad", default=os.environ.get("FREECADCMD", "FreeCADCmd"),
+                        help="FreeCADCmd executable used to run the workers")
+    parser.add_argument("--workers", type=int, default=2, help="Number of warm worker processes")
+    parser.add_argument("--max-queue", type=int, default=64, help="Requests allowed to wait for a worker")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Default per request timeout in seconds")
+    parser.add_argument("--output-dir", help="Directory specs may write files to, file output is disabled without it")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of TCP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_queue < 0:
+        parser.error("--max-queue must not be negative")
+    if not 0 < args.timeout < float("inf"):
+        parser.error("--timeout must be a positive number of seconds")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
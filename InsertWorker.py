@@ -0,0 +1,108 @@
+"""
+Headless build worker used by InsertServer.
+
+Started by InsertServer as
+FreeCADCmd -c "import InsertWorker; InsertWorker.main()" since FreeCADCmd
+imports a .py argument as a module instead of running it as __main__. The
+workbench modules are imported once at startup, then main() reads one JSON
+request per line from stdin and writes one JSON reply per line to stdout
+until stdin is closed.
+"""
+import os, json, base64, tempfile, time, traceback
+
+import FreeCAD
+import BoxMaker
+import CompartmentMaker
+
+FORMATS = {"stl": "exportStl", "step": "exportStep"}
+
+def set_properties(obj, props):
+    for name, value in props.items():
+        if name not in obj.PropertiesList:
+            raise ValueError(f"{obj.Name} has no property '{name}'")
+        setattr(obj, name, value)
+
+def build(spec):
+    """
+    Builds one box from a spec and exports it.
+
+    Args:
+        spec (dict): "box" holds BoxFeature properties, "compartments" a list
+            of CompartmentFeature properties plus an optional "Position"
+            [x, y], "format" is "stl" or "step" and "output" an optional
+            file path to write instead of returning the bytes. The server
+            resolves "output" and it must lie in BIW_OUTPUT_DIR.
+
+    Returns:
+        dict: The reply to send back to the server.
+    """
+    fmt = spec.get("format", "stl").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'")
+    output = spec.get("output")
+    if output:
+        output_dir = os.environ.get("BIW_OUTPUT_DIR")
+        if not output_dir or os.path.dirname(os.path.realpath(output)) != os.path.realpath(output_dir):
+            raise ValueError("output is outside the server output directory")
+    doc = FreeCAD.newDocument("InsertWorker")
+    try:
+        box = doc.addObject("Part::FeaturePython", "InsertBox")
+        BoxMaker.BoxFeature(box)
+        set_properties(box, spec.get("box", {}))
+        compartments = []
+        for comp_spec in spec.get("compartments", []):
+            comp_spec = dict(comp_spec)
+            x, y = comp_spec.pop("Position", (2, 2))
+            comp = doc.addObject("Part::FeaturePython", "Compartment")
+            CompartmentMaker.CompartmentFeature(comp)
+            # ShapeType decides which other properties exist
+            if "ShapeType" in comp_spec:
+                comp.ShapeType = comp_spec.pop("ShapeType")
+            comp.ZOffset = box.Height - box.LidThickness if box.Lid else 0
+            set_properties(comp, comp_spec)
+            comp.Placement = FreeCAD.Placement(FreeCAD.Vector(x, y, 0), FreeCAD.Rotation())
+            compartments.append(comp)
+        box.Compartments = compartments
+        doc.recompute()
+        if box.Shape.isNull():
+            raise RuntimeError("Box recompute produced no shape")
+
+        if output:
+            getattr(box.Shape, FORMATS[fmt])(output)
+            return {"ok": True, "path": output}
+        fd, path = tempfile.mkstemp(suffix="." + fmt)
+        os.close(fd)
+        try:
+            getattr(box.Shape, FORMATS[fmt])(path)
+            with open(path, "rb") as f:
+                data = f.read()
+        finally:
+            os.remove(path)
+        return {"ok": True, "data": base64.b64encode(data).decode("ascii")}
+    finally:
+        FreeCAD.closeDocument(doc.Name)
+
+def handle(line):
+    """Turns one request line into the reply, reporting build errors instead of raising."""
+    start = time.perf_counter()
+    try:
+        reply = build(json.loads(line))
+    except Exception as e:
+        traceback.print_exc()
+        reply = {"ok": False, "error": str(e)}
+    reply["build_time"] = time.perf_counter() - start
+    return reply
+
+def main():
+    # FreeCAD writes console output to fd 1, so keep a private copy of it for
+    # the protocol and send everything else to stderr
+    replies = os.fdopen(os.dup(1), "w")
+    requests = os.fdopen(os.dup(0), "r")
+    os.dup2(2, 1)
+    replies.write(json.dumps({"ready": True, "pid": os.getpid()}) + "\n")
+    replies.flush()
+    for line in requests:
+        if not line.strip():
+            continue
+        replies.write(json.dumps(handle(line)) + "\n")
+        replies.flush()
@@ -0,0 +1,23 @@
+"""
+Stand-in for InsertWorker that speaks the same line protocol without FreeCAD.
+
+Specs may hold "sleep" (seconds before replying), "fail" (reply with an
+error) and "crash" (exit without replying).
+"""
+import os, sys, json, time
+
+print("FreeCAD banner", flush=True)
+print(json.dumps({"ready": True, "pid": os.getpid()}), flush=True)
+for line in sys.stdin:
+    spec = json.loads(line)
+    if spec.get("crash"):
+        sys.exit(1)
+    time.sleep(spec.get("sleep", 0))
+    if spec.get("fail"):
+        reply = {"ok": False, "error": "stub failure"}
+    elif spec.get("output"):
+        reply = {"ok": True, "path": spec["output"]}
+    else:
+        reply = {"ok": True, "data": "c3R1Yg==", "pid": os.getpid()}
+    reply["build_time"] = spec.get("sleep", 0)
+    print(json.dumps(reply), flush=True)
@@ -0,0 +1,182 @@
+import os, sys, json, signal, asyncio
+import pytest
+
+import InsertServer
+
+STUB = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_worker.py")]
+
+def run(coro_fn, size=2, max_queue=64, timeout=5.0, output_dir=None):
+    """Runs coro_fn(pool, request) against a served pool of stub workers."""
+    async def main():
+        pool = InsertServer.WorkerPool(STUB, size, max_queue, timeout)
+        await pool.start()
+        server = InsertServer.InsertServer(pool, output_dir)
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0, limit=InsertServer.REQUEST_LIMIT)
+        port = listener.sockets[0].getsockname()[1]
+
+        async def request(*lines):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=InsertServer.LINE_LIMIT)
+            replies = []
+            for line in lines:
+                writer.write((line if isinstance(line, str) else json.dumps(line)).encode() + b"\n")
+                await writer.drain()
+                replies.append(json.loads(await reader.readline()))
+            writer.close()
+            return replies[0] if len(replies) == 1 else replies
+
+        try:
+            return await coro_fn(pool, request)
+        finally:
+            listener.close()
+            await pool.close()
+    return asyncio.run(main())
+
+def test_builds():
+    async def check(pool, request):
+        return await asyncio.gather(*[request({"id": i, "spec": {"sleep": 0.1}}) for i in range(6)])
+    replies = run(check)
+    assert [r["id"] for r in replies] == list(range(6))
+    assert all(r["ok"] and r["data"] == "c3R1Yg==" for r in replies)
+    assert len({r["pid"] for r in replies}) == 2
+
+def test_queue_full_is_rejected():
+    async def check(pool, request):
+        busy = asyncio.ensure_future(request({"spec": {"sleep": 0.5}}))
+        await asyncio.sleep(0.1)
+        waiting = asyncio.ensure_future(request({"spec": {}}))
+        await asyncio.sleep(0.1)
+        rejected = await request({"spec": {}})
+        return await busy, await waiting, rejected, pool.status()
+    busy, waiting, rejected, status = run(check, size=1, max_queue=1)
+    assert busy["ok"] and waiting["ok"]
+    assert rejected == {"ok": False, "error": "Request queue is full"}
+    assert status["rejected"] == 1 and status["completed"] == 2
+
+def test_queue_limit_zero_serves_idle_workers():
+    async def check(pool, request):
+        first = await request({"spec": {}})
+        busy = asyncio.ensure_future(request({"spec": {"sleep": 0.5}}))
+        await asyncio.sleep(0.1)
+        rejected = await request({"spec": {}})
+        return first, await busy, rejected
+    first, busy, rejected = run(check, size=1, max_queue=0)
+    assert first["ok"] and busy["ok"]
+    assert rejected == {"ok": False, "error": "Request queue is full"}
+
+def test_timeout_replaces_worker():
+    async def check(pool, request):
+        first = await request({"spec": {}})
+        timed_out = await request({"spec": {"sleep": 5}, "timeout": 0.3})
+        after = await request({"spec": {}, "timeout": 10})
+        return first, timed_out, after, pool.status()
+    first, timed_out, after, status = run(check, size=1)
+    assert timed_out == {"ok": False, "error": "Timed out after 0.3s"}
+    assert after["ok"] and after["pid"] != first["pid"]
+    assert status["timeouts"] == 1 and status["workers"] == 1
+
+def test_crash_replaces_worker():
+    async def check(pool, request):
+        crashed = await request({"spec": {"crash": True}})
+        after = await request({"spec": {}, "timeout": 10})
+        return crashed, after, pool.status()
+    crashed, after, status = run(check, size=1)
+    assert not crashed["ok"] and "exited" in crashed["error"]
+    assert after["ok"] and status["failed"] == 1
+
+def test_dead_idle_worker_is_replaced():
+    async def check(pool, request):
+        first = await request({"spec": {}})
+        os.kill(first["pid"], signal.SIGKILL)
+        await asyncio.sleep(0.2)
+        after = await request({"spec": {}, "timeout": 10})
+        return first, after, pool.status()
+    first, after, status = run(check, size=1)
+    assert after["ok"] and after["pid"] != first["pid"]
+    assert status["failed"] == 0 and status["workers"] == 1
+
+def test_queue_wait_timeout_keeps_worker():
+    async def check(pool, request):
+        busy = asyncio.ensure_future(request({"spec": {"sleep": 0.5}}))
+        await asyncio.sleep(0.1)
+        timed_out = await request({"spec": {}, "timeout": 0.1})
+        return await busy, timed_out, await request({"spec": {}})
+    busy, timed_out, after = run(check, size=1)
+    assert not timed_out["ok"]
+    assert busy["pid"] == after["pid"]
+
+def test_malformed_requests():
+    async def check(pool, request):
+        return await request(
+            "not json",
+            [1, 2],
+            {"cmd": "nope"},
+            {"spec": [1]},
+            {"spec": {}, "timeout": "5"},
+            {"spec": {}, "timeout": -1},
+            {"spec": {}, "timeout": 0},
+            {"spec": {}, "timeout": True},
+            {"spec": {"output": "out.stl"}},
+            {"id": 7, "spec": {}},
+        )
+    replies = run(check)
+    assert all(not r["ok"] for r in replies[:-1])
+    assert "positive" in replies[4]["error"] and "positive" in replies[6]["error"]
+    assert "--output-dir" in replies[8]["error"]
+    # the connection survives all of the above
+    assert replies[-1]["ok"] and replies[-1]["id"] == 7
+
+def test_request_too_large():
+    async def check(pool, request):
+        too_large = await request({"spec": {"padding": "x" * InsertServer.REQUEST_LIMIT}})
+        return too_large, await request({"spec": {}})
+    too_large, after = run(check)
+    assert too_large == {"ok": False, "error": "Request too large"}
+    assert after["ok"]
+
+def test_output_dir(tmp_path):
+    async def check(pool, request):
+        return await request(
+            {"spec": {"output": "insert.step", "format": "step"}},
+            {"spec": {"output": True, "format": "step"}},
+            {"spec": {"output": "../escape.stl"}},
+            {"spec": {"output": "/etc/passwd"}},
+        )
+    named, generated, parent, absolute = run(check, output_dir=str(tmp_path))
+    assert named["path"] == os.path.join(os.path.realpath(tmp_path), "insert.step")
+    assert os.path.dirname(generated["path"]) == os.path.realpath(tmp_path)
+    assert generated["path"].endswith(".step")
+    assert not parent["ok"] and not absolute["ok"]
+
+def test_metrics():
+    async def check(pool, request):
+        await request({"spec": {"sleep": 0.1}}, {"spec": {"fail": True}})
+        return await request({"cmd": "metrics"})
+    reply = run(check)
+    metrics = reply["metrics"]
+    assert reply["ok"]
+    assert metrics["requests"] == 2 and metrics["completed"] == 1 and metrics["failed"] == 1
+    assert metrics["workers"] == 2 and metrics["idle"] == 2 and metrics["queued"] == 0
+    assert metrics["latency"]["p50"] >= 0.1 and metrics["build_time_mean"] == pytest.approx(0.1)
+    assert metrics["throughput"] > 0
+
+def test_failed_start_stops_workers(monkeypatch):
+    calls, started = [], []
+    real_start = InsertServer.Worker.start
+
+    async def flaky_start(command, startup_timeout, env=None):
+        calls.append(command)
+        if len(calls) > 1:
+            raise RuntimeError("boom")
+        worker = await real_start(command, startup_timeout, env)
+        started.append(worker)
+        return worker
+
+    async def check():
+        pool = InsertServer.WorkerPool(STUB, 2)
+        with pytest.raises(RuntimeError):
+            await pool.start()
+        return pool
+    monkeypatch.setattr(InsertServer.Worker, "start", flaky_start)
+    pool = asyncio.run(check())
+    assert not pool._workers
+    assert started and started[0].proc.returncode is not None
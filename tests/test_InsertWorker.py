@@ -0,0 +1,50 @@
+import os, json, base64
+import pytest
+
+FreeCAD = pytest.importorskip("FreeCAD")
+# also checks that the makers import without the GUI
+import InsertWorker
+
+SPEC = {
+    "box": {"Length": 120, "Width": 80, "Height": 30, "Lid": True},
+    # ShapeType must be applied before Radius exists
+    "compartments": [{"ShapeType": "Cylinder", "Radius": 12, "Depth": 20, "Position": [10, 10]}],
+}
+
+@pytest.mark.parametrize("fmt", ["stl", "step"])
+def test_build_returns_data(fmt):
+    docs = set(FreeCAD.listDocuments())
+    reply = InsertWorker.build(dict(SPEC, format=fmt))
+    assert reply["ok"]
+    data = base64.b64decode(reply["data"])
+    assert data
+    if fmt == "step":
+        assert data.startswith(b"ISO-10303-21")
+    assert set(FreeCAD.listDocuments()) == docs
+
+@pytest.mark.parametrize("fmt", ["stl", "step"])
+def test_build_writes_output(tmp_path, monkeypatch, fmt):
+    monkeypatch.setenv("BIW_OUTPUT_DIR", str(tmp_path))
+    path = os.path.join(str(tmp_path), f"insert.{fmt}")
+    reply = InsertWorker.build(dict(SPEC, format=fmt, output=path))
+    assert reply == {"ok": True, "path": path}
+    assert os.path.getsize(path) > 0
+
+def test_output_outside_dir_is_refused(tmp_path, monkeypatch):
+    monkeypatch.setenv("BIW_OUTPUT_DIR", str(tmp_path / "out"))
+    with pytest.raises(ValueError, match="outside"):
+        InsertWorker.build(dict(SPEC, output=str(tmp_path / "insert.stl")))
+    assert not (tmp_path / "insert.stl").exists()
+
+def test_unknown_property_is_an_error():
+    docs = set(FreeCAD.listDocuments())
+    with pytest.raises(ValueError, match="no property 'Bogus'"):
+        InsertWorker.build({"box": {"Bogus": 1}})
+    with pytest.raises(ValueError, match="no property 'Sides'"):
+        InsertWorker.build({"compartments": [{"ShapeType": "Box", "Sides": 6}]})
+    assert set(FreeCAD.listDocuments()) == docs
+
+def test_handle_replies_with_error():
+    reply = InsertWorker.handle(json.dumps({"box": {"Bogus": 1}, "format": "step"}))
+    assert reply["ok"] is False and "Bogus" in reply["error"]
+    assert "build_time" in reply